@@ -8,10 +8,9 @@ Copyright (c) 2012, Francois Jeannotte.
 
 import ctypes
 import itertools
-import msvcrt
+import operator
 import os
 import sys
-import time
 
 import win32console
 
@@ -32,16 +31,73 @@ class CONSOLE_SCREEN_BUFFER_INFO(ctypes.Structure):
               ("srWindow"           , SMALL_RECT), 
               ("dwMaximumWindowSize", COORD)]
 
-k32 = ctypes.windll.kernel32
-stdout = k32.GetStdHandle(-11)
+class CHAR_INFO(ctypes.Structure):
+  _fields_ = [("UnicodeChar", ctypes.c_wchar),
+              ("Attributes" , ctypes.c_ushort)]
+
+class KEY_EVENT_RECORD(ctypes.Structure):
+  _fields_ = [("bKeyDown"         , ctypes.c_long),
+              ("wRepeatCount"     , ctypes.c_ushort),
+              ("wVirtualKeyCode"  , ctypes.c_ushort),
+              ("wVirtualScanCode" , ctypes.c_ushort),
+              ("UnicodeChar"      , ctypes.c_wchar),
+              ("dwControlKeyState", ctypes.c_ulong)]
+
+class INPUT_RECORD(ctypes.Structure):
+  # KEY_EVENT_RECORD is the largest member of the Event union, so the other
+  # event types (mouse, focus, etc.) fit in the same record.
+  _fields_ = [("EventType", ctypes.c_ushort),
+              ("KeyEvent" , KEY_EVENT_RECORD)]
+
+STD_OUTPUT_HANDLE    = -11
+INFINITE             = 0xFFFFFFFF
+WAIT_FAILED          = 0xFFFFFFFF
+KEY_EVENT            = 0x0001
+GENERIC_READ         = 0x80000000
+GENERIC_WRITE        = 0x40000000
+FILE_SHARE_READ      = 0x00000001
+FILE_SHARE_WRITE     = 0x00000002
+OPEN_EXISTING        = 3
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+# Private kernel32 instance: the function prototypes set below would otherwise
+# apply to the ctypes.windll.kernel32 functions shared by every module
+k32 = ctypes.WinDLL('kernel32', use_last_error=True)
+stdout = k32.GetStdHandle(STD_OUTPUT_HANDLE)
+pywin_stdout = win32console.GetStdHandle(win32console.STD_OUTPUT_HANDLE)
+
+k32.GetConsoleScreenBufferInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(CONSOLE_SCREEN_BUFFER_INFO)]
+k32.CreateFileW.argtypes = [ctypes.c_wchar_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_void_p,
+                            ctypes.c_ulong, ctypes.c_ulong, ctypes.c_void_p]
+k32.CreateFileW.restype = ctypes.c_void_p
+k32.WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+k32.WaitForSingleObject.restype = ctypes.c_ulong
+k32.GetNumberOfConsoleInputEvents.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulong)]
+k32.ReadConsoleInputW.argtypes = [ctypes.c_void_p, ctypes.POINTER(INPUT_RECORD), ctypes.c_ulong,
+                                  ctypes.POINTER(ctypes.c_ulong)]
+
+# Console input handle, opened by the first wait_key call
+_conin = None
+
+# Reused by getcurpos to avoid allocating a structure on every call
+_conInfo    = CONSOLE_SCREEN_BUFFER_INFO()
+_conInfoRef = ctypes.byref(_conInfo)
+
+# Console attribute flags by name, as accepted by set_text_color
+colorFlags = dict((name, val) for name, val in vars(win32console).iteritems()
+                  if name.startswith(('FOREGROUND_', 'BACKGROUND_', 'COMMON_LVB_')))
+defaultColorFlags = colorFlags['FOREGROUND_BLUE'] | colorFlags['FOREGROUND_GREEN'] | colorFlags['FOREGROUND_RED']
+
+# Combined flags of the color lists previously passed to set_text_color
+_colorFlagsCache = dict()
 
 def getcurpos():
   """
-  Returns the cursor position as a COORD.
+  Returns the cursor position as a (x, y) tuple.
   """
-  conInfo = CONSOLE_SCREEN_BUFFER_INFO()
-  k32.GetConsoleScreenBufferInfo(stdout, ctypes.byref(conInfo)) 
-  return conInfo.dwCursorPosition
+  k32.GetConsoleScreenBufferInfo(stdout, _conInfoRef)
+  pos = _conInfo.dwCursorPosition
+  return (pos.x, pos.y)
 
 def setcurpos(x, y):
   """
@@ -51,22 +107,102 @@ def setcurpos(x, y):
   
 def putchxy(x, y, ch):
   """
-  Puts a char at the specified position. The cursor position is not affected.
+  Puts a char at the specified position, in the current text attributes. The
+  cursor position is not affected. When updating many positions, prefer
+  calling putcells once.
+  """
+  k32.GetConsoleScreenBufferInfo(stdout, _conInfoRef)
+  putcells([(x, y, ch, _conInfo.wAttributes)])
+
+def _console_codec():
+  """
+  Returns the codec of the console output code page.
   """
-  prevCurPos = getcurpos()
-  setcurpos(x, y)
-  msvcrt.putch(ch)
-  setcurpos(prevCurPos.x, prevCurPos.y)
+  cp = k32.GetConsoleOutputCP()
+  return 'utf-8' if cp == 65001 else 'cp%d' % (cp,)
+
+def putcells(cells):
+  """
+  Puts chars at the specified positions using a single console write. The
+  cursor position is not affected.
+  Parameters:
+    cells: a sequence of (x, y, ch, attr) tuples. If attr is None, the
+           attributes (colors) already displayed at that position are kept.
+           A str ch is decoded with the console output code page.
+  """
+  if not cells:
+    return
+  left   = min(c[0] for c in cells)
+  top    = min(c[1] for c in cells)
+  right  = max(c[0] for c in cells)
+  bottom = max(c[1] for c in cells)
+  width  = right - left + 1
+  height = bottom - top + 1
+  buf    = (CHAR_INFO * (width * height))()
+  size   = COORD(width, height)
+  origin = COORD(0, 0)
+  rect   = SMALL_RECT(left, top, right, bottom)
+
+  # Load the current content of the rectangle, so positions that are not part
+  # of the batch are written back unchanged. Not needed when the batch sets
+  # every position and attribute of the rectangle, as putchxy does.
+  if (any(c[3] is None for c in cells) or
+      len(set((c[0], c[1]) for c in cells)) < width * height):
+    k32.ReadConsoleOutputW(stdout, buf, size, origin, ctypes.byref(rect))
+  codec = None
+  for x, y, ch, attr in cells:
+    if isinstance(ch, str):
+      codec = codec or _console_codec()
+      ch = ch.decode(codec, 'replace')
+    cell = buf[(y - top) * width + (x - left)]
+    cell.UnicodeChar = ch
+    if attr is not None:
+      cell.Attributes = attr
+  k32.WriteConsoleOutputW(stdout, buf, size, origin, ctypes.byref(rect))
   
+def _check(result):
+  """
+  Raises the last Windows error if a console call failed (returned 0).
+  """
+  if not result:
+    raise ctypes.WinError(ctypes.get_last_error())
+  return result
+
+def _get_conin():
+  """
+  Returns the console input handle. Like msvcrt.getch, CONIN$ is opened, so
+  the console is read even when stdin is redirected.
+  """
+  global _conin
+  if _conin is None:
+    handle = k32.CreateFileW(u'CONIN$', GENERIC_READ | GENERIC_WRITE, FILE_SHARE_READ | FILE_SHARE_WRITE,
+                             None, OPEN_EXISTING, 0, None)
+    if handle == INVALID_HANDLE_VALUE:
+      raise ctypes.WinError(ctypes.get_last_error())
+    _conin = handle
+  return _conin
+
 def wait_key():
   """
   Waits until a key is pressed. Returns the key.
+
+  The console input handle is waited on directly (no polling). Input events
+  other than key presses (key releases, mouse, focus, buffer resize) and keys
+  that do not produce a character (shift, ctrl, etc.) are discarded.
   """
+  conin = _get_conin()
+  rec   = INPUT_RECORD()
+  count = ctypes.c_ulong()
   while True:
-    if msvcrt.kbhit():
-      return msvcrt.getch()
-    else:
-      time.sleep(0.01)
+    if k32.WaitForSingleObject(conin, INFINITE) == WAIT_FAILED:
+      raise ctypes.WinError(ctypes.get_last_error())
+    _check(k32.GetNumberOfConsoleInputEvents(conin, ctypes.byref(count)))
+    while count.value > 0:
+      _check(k32.ReadConsoleInputW(conin, ctypes.byref(rec), 1, ctypes.byref(count)))
+      key = rec.KeyEvent
+      if rec.EventType == KEY_EVENT and key.bKeyDown and key.UnicodeChar != u'\0':
+        return key.UnicodeChar
+      _check(k32.GetNumberOfConsoleInputEvents(conin, ctypes.byref(count)))
 
 def set_text_color(colors=None):
   """
@@ -75,27 +211,27 @@ def set_text_color(colors=None):
   strings.
   """
 
-  flags = 0
-
   # If colors is None, use defaults colors
   if not colors:
-    flags = win32console.FOREGROUND_BLUE | win32console.FOREGROUND_GREEN | win32console.FOREGROUND_RED
+    flags = defaultColorFlags
 
   # colors is set, process it
   else:
 
     # If colors is a single string, use this as the single flag
     if isinstance(colors, basestring):
-      flags = win32console.__dict__[colors]
+      flags = colorFlags[colors]
 
     # Otherwise, consider colors a list of strings
     else:
-      for color in colors:
-        flags = flags | win32console.__dict__[color]
+      colors = tuple(colors)
+      flags = _colorFlagsCache.get(colors)
+      if flags is None:
+        flags = reduce(operator.or_, (colorFlags[c] for c in colors), 0)
+        _colorFlagsCache[colors] = flags
 
   # Set the color
-  h = win32console.GetStdHandle(win32console.STD_OUTPUT_HANDLE)
-  h.SetConsoleTextAttribute(flags)
+  pywin_stdout.SetConsoleTextAttribute(flags)
 
 def write_color(text, colors, endline=False):
   """
@@ -111,10 +247,8 @@ def write_color(text, colors, endline=False):
 
 def get_console_size():
   """ Returns a (X, Y) tuple. """
-  h = win32console.GetStdHandle(win32console.STD_OUTPUT_HANDLE)
-  x = h.GetConsoleScreenBufferInfo()['MaximumWindowSize'].X
-  y = h.GetConsoleScreenBufferInfo()['MaximumWindowSize'].Y
-  return (x,y)
+  size = pywin_stdout.GetConsoleScreenBufferInfo()['MaximumWindowSize']
+  return (size.X, size.Y)
 
 def cls():
   """ Clears the screen. """
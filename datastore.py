@@ -11,12 +11,12 @@ This module defines three concrete DataStore classes:
 
 All DataStore classes respect the following interface. The term "obj" (as in
 getobj and setobj) refers to a Python object, that will be converted to a
-binary buffer using the pickling protocol version 2. The term "data" (as in
-getdata and setdata) refers to a binary buffer, that should be written into the
-concrete DataStore. External clients will use getobj/setobj, while
-getdata/setdata will mostly be used internally.  getobj/setobj accept
-parameters to specify the encoding (e.g., compression, encryption), while
-getdata/setdata do not alter the binary buffer in any way.
+binary buffer using the pickling protocol version 2 (or msgpack, see SerAlgo).
+The term "data" (as in getdata and setdata) refers to a binary buffer, that
+should be written into the concrete DataStore. External clients will use
+getobj/setobj, while getdata/setdata will mostly be used internally.
+getobj/setobj accept parameters to specify the encoding (e.g., compression,
+encryption), while getdata/setdata do not alter the binary buffer in any way.
   1. getid()            -> returns the ID of the store (a string)
   2. getdata(key)       -> returns tuple (data, update_time)
   3. getobj(key)        -> returns tuple (obj, update_time)
@@ -41,27 +41,166 @@ import binascii
 import bz2
 import contextlib
 import cPickle
+import cStringIO
 import datetime
+import errno
 import functools
 import hashlib
 import itertools
+import mmap
 import os
 import os.path
+import struct
 import time
 import timeit
 import util
 import uuid
 import zlib
 
-import Crypto.Cipher.AES
 import dpapi
 
-CompAlgo    = util.Enum('uncompressed zlib bz2')
-CryptAlgo   = util.Enum('unencrypted AES')
+# pycryptodomex is preferred since it uses AES-NI when available; the legacy
+# pycrypto package provides the same interface.
+try:
+  from Cryptodome.Cipher import AES
+  from Cryptodome.Util import Counter
+except ImportError:
+  from Crypto.Cipher import AES
+  from Crypto.Util import Counter
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None # msgpack serialization is unavailable
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None # zstd compression is unavailable
+
+CompAlgo    = util.Enum('uncompressed zlib bz2 zstd zstd_mt')
+CryptAlgo   = util.Enum('unencrypted AES AES_CTR')
 ProtectAlgo = util.Enum('unprotected DPAPI')
+SerAlgo     = util.Enum('pickle msgpack')
 
 trace_sql = False
 
+# Serialized objects smaller than these sizes are stored uncompressed: the
+# compression setup cost and format overhead exceed the savings
+comp_thresholds = {CompAlgo.zlib: 128, CompAlgo.bz2: 1024, CompAlgo.zstd: 128,
+                   CompAlgo.zstd_mt: 128}
+
+# Dir store files of at least this size are memory-mapped by Dir.getobj
+mmap_threshold = 64*1024
+
+_O_BINARY = getattr(os, 'O_BINARY', 0) # Only defined (and needed) on Windows
+
+# AES keys derived from the passwords recently used, by password
+_crypt_keys = dict()
+_crypt_keys_max = 64
+
+def _get_crypt_key(crypt_pwd):
+  key = _crypt_keys.get(crypt_pwd)
+  if key is None:
+    if len(_crypt_keys) >= _crypt_keys_max:
+      _crypt_keys.clear()
+    key = hashlib.sha256(crypt_pwd).digest()
+    _crypt_keys[crypt_pwd] = key
+  return key
+
+def _new_cipher(crypt_algo, crypt_pwd, IV):
+  """
+  Returns an AES cipher object. CryptAlgo.AES uses the CFB mode, while
+  CryptAlgo.AES_CTR uses the CTR mode with the IV as the initial counter. CTR
+  is much faster, since blocks do not depend on the previous ciphertext.
+  """
+  key = _get_crypt_key(crypt_pwd)
+  if crypt_algo == CryptAlgo.AES_CTR:
+    counter = Counter.new(128, initial_value=long(binascii.hexlify(IV), 16), allow_wraparound=True)
+    return AES.new(key, AES.MODE_CTR, counter=counter)
+  return AES.new(key, AES.MODE_CFB, IV)
+
+def _is_pycryptodome():
+  """
+  Returns True if AES comes from pycryptodome, whose ciphers accept an output
+  buffer and memoryview inputs. pycrypto ciphers always return a new string,
+  and only accept strings and buffer objects.
+  """
+  try:
+    AES.new(16*'\0', AES.MODE_ECB).encrypt(16*'\0', output=bytearray(16))
+  except TypeError:
+    return False
+  return True
+
+_pycryptodome = _is_pycryptodome()
+
+def _cipher_input(buf, pos):
+  """
+  Returns a view of buf starting at pos, that the AES ciphers accept.
+  """
+  if not _pycryptodome:
+    return buffer(buf, pos)
+  if isinstance(buf, mmap.mmap):
+    return buf[pos:] # Python 2 mmap objects cannot be viewed by memoryview
+  return memoryview(buf)[pos:]
+
+# Headers of protocol versions 0 and 1 (see DataStore)
+_header_v0 = struct.Struct('BB')
+_header_v1 = struct.Struct('BBB')
+
+def _cached_query(build_query):
+  """
+  Decorator for the SqliteTable methods building SQL statements. A statement
+  is built only once for a given table class and arguments, then reused. Since
+  apsw caches prepared statements by SQL text, reusing the same text also
+  skips the SQLite parsing.
+  """
+  queries = dict()
+  @functools.wraps(build_query)
+  def wrapper(cls, *args):
+    key = (cls,) + args
+    query = queries.get(key)
+    if query is None:
+      query = queries[key] = build_query(cls, *args)
+    return query
+  return wrapper
+
+def _check_module(module, name, feature):
+  if module is None:
+    raise Exception('{} requires the {} module'.format(feature, name))
+
+def _msgpack_dumps(obj):
+  """
+  Returns the msgpack encoding of obj, or None if msgpack is unavailable or
+  cannot encode obj exactly. With strict_types, tuples and subclasses of the
+  base types are rejected instead of being converted, so they get pickled.
+  """
+  if msgpack is None:
+    return None
+  try:
+    return msgpack.packb(obj, use_bin_type=True, strict_types=True)
+  except (TypeError, ValueError, OverflowError):
+    return None
+
+def _msgpack_loads(buf):
+  _check_module(msgpack, 'msgpack', 'msgpack serialization')
+  return msgpack.unpackb(buf, raw=False, strict_map_key=False)
+
+def _iter_files(path):
+  """
+  Yields the DirEntry of each file under path, recursively. Like os.walk,
+  symbolic links to directories are not followed. The entries come from the
+  directory listing, so their stat() is free on Windows.
+  """
+  dirs = [path]
+  while dirs:
+    for entry in util.scandir(dirs.pop()):
+      if entry.is_dir():
+        if not entry.is_symlink():
+          dirs.append(entry.path)
+      else:
+        yield entry
+
 class DataStore(object):
   """
   Here is the layout of the header
@@ -73,38 +212,53 @@ class DataStore(object):
 
         bits: 0 0 0         | 0 0 0          |  0 0
               comp (3 bits) | crypt (3 bits) |  protect (2 bits)
+
+  - protocol version 1:
+
+    - bytes 0 and 1: same as protocol version 0
+    - byte 2: the serialization algorithm (SerAlgo)
+
+  Version 0 implies SerAlgo.pickle, and it is still used for pickled objects.
   """
 
+  __slots__ = ('_comp_algo', '_comp_level', '_crypt_algo', '_crypt_pwd', '_protect_algo', '_ser_algo')
+
   def __init__(self, comp_algo=CompAlgo.uncompressed, comp_level=5, crypt_algo=CryptAlgo.unencrypted,
-               crypt_pwd=None, protect_algo=ProtectAlgo.unprotected):
+               crypt_pwd=None, protect_algo=ProtectAlgo.unprotected, ser_algo=SerAlgo.pickle):
     """
-    Creates a datastore with default values for the three encoding parameters.
+    Creates a datastore with default values for the encoding parameters.
     Those parameters can be changed for each call to setobj.
     """
     assert CompAlgo.validate(comp_algo)
     assert comp_level >= 1 and comp_level <= 9
     assert CryptAlgo.validate(crypt_algo)
     assert ProtectAlgo.validate(protect_algo)
-
-    # Create a private dict of attributes. This is used to store all internal
-    # attributes. This is necessary because we override getattr and setattr.
-    self.__dict__['_priv'] = dict()
-    self._priv['_comp_algo']    = comp_algo
-    self._priv['_comp_level']   = comp_level
-    self._priv['_crypt_algo']   = crypt_algo
-    self._priv['_crypt_pwd']    = crypt_pwd
-    self._priv['_protect_algo'] = protect_algo
+    assert SerAlgo.validate(ser_algo)
+
+    # Internal attributes start with an underscore and are declared in
+    # __slots__, so they are found without going through __getattr__. Any
+    # other attribute name is a key of the store (see __getattr__ and
+    # __setattr__).
+    self._comp_algo    = comp_algo
+    self._comp_level   = comp_level
+    self._crypt_algo   = crypt_algo
+    self._crypt_pwd    = crypt_pwd
+    self._protect_algo = protect_algo
+    self._ser_algo     = ser_algo
 
   def __getattr__(self, name):
-    if name in self._priv:
-      return self._priv[name]
+    if name.startswith('_'):
+      raise AttributeError(name)
     (obj, upd_time) = self.getobj(name)
     if obj != None:
       return obj
     raise AttributeError('key {} does not exist in the store'.format(name))  
 
   def __setattr__(self, name, value):
-    self.setobj(name, value)
+    if name.startswith('_'):
+      object.__setattr__(self, name, value)
+    else:
+      self.setobj(name, value)
 
   def getobj(self, key, crypt_pwd=None):
     """
@@ -118,14 +272,24 @@ class DataStore(object):
     buf, upd_time = self.getdata(key)
     if not buf:
       return (None, None)
+    return self._decode(buf, crypt_pwd), upd_time
 
-    # Get the protocol version
-    proto_ver = ord(buf[0])
-    assert proto_ver == 0
+  def _decode(self, buf, crypt_pwd):
+    """
+    Decodes a buffer produced by setobj, and returns the object.
+    """
 
-    # Decode the header
-    header = ord(buf[1])
-    buf = buf[2:]
+    # Decode the header. To avoid copying the payload, it is not sliced out of
+    # buf: pos is its offset in buf, until a decoding step returns a new buffer.
+    proto_ver, header = _header_v0.unpack_from(buf)
+    if proto_ver == 0:
+      ser_algo = SerAlgo.pickle
+      pos = _header_v0.size
+    else:
+      assert proto_ver == 1
+      proto_ver, header, ser_algo = _header_v1.unpack_from(buf)
+      pos = _header_v1.size
+    assert SerAlgo.validate(ser_algo)
     comp_algo    = (header & 0b11100000) >> 5
     crypt_algo   = (header & 0b00011100) >> 2
     protect_algo = (header & 0b00000011)
@@ -135,29 +299,35 @@ class DataStore(object):
 
     # Unprotect
     if protect_algo == ProtectAlgo.DPAPI:
-      buf = dpapi.decryptData(buf)
+      buf, pos = dpapi.decryptData(buf[pos:]), 0
 
     # Decrypt
-    if crypt_algo == CryptAlgo.AES:
+    if crypt_algo != CryptAlgo.unencrypted:
       if crypt_pwd == None:
         crypt_pwd = self._crypt_pwd
       assert crypt_pwd
-      IV = buf[:16] 
-      buf = buf[16:] 
-      crypt_key = hashlib.sha256(crypt_pwd).digest() 
-      crypt_key = Crypto.Cipher.AES.new(crypt_key, Crypto.Cipher.AES.MODE_CFB, IV) 
-      buf = crypt_key.decrypt(buf)
+      IV = buf[pos:pos+16]
+      buf, pos = _new_cipher(crypt_algo, crypt_pwd, IV).decrypt(_cipher_input(buf, pos+16)), 0
 
     # Decompress
     if comp_algo == CompAlgo.zlib:
-      buf = zlib.decompress(buf)
+      buf, pos = zlib.decompress(buffer(buf, pos)), 0
     elif comp_algo == CompAlgo.bz2:
-      buf = bz2.decompress(buf)
+      buf, pos = bz2.decompress(buffer(buf, pos)), 0
+    elif comp_algo in (CompAlgo.zstd, CompAlgo.zstd_mt):
+      _check_module(zstandard, 'zstandard', 'zstd compression')
+      buf, pos = zstandard.ZstdDecompressor().decompress(buffer(buf, pos)), 0
       
-    # Unpickle the object and return it
-    return cPickle.loads(buf), upd_time
+    # Deserialize the object and return it. cPickle only reads strings, but a
+    # cStringIO object reads buf in place.
+    if ser_algo == SerAlgo.msgpack:
+      return _msgpack_loads(buffer(buf, pos))
+    f = cStringIO.StringIO(buf)
+    f.seek(pos)
+    return cPickle.load(f)
 
-  def setobj(self, key, obj, comp_algo=None, comp_level=None, crypt_algo=None, crypt_pwd=None, protect_algo=None):
+  def setobj(self, key, obj, comp_algo=None, comp_level=None, crypt_algo=None, crypt_pwd=None, protect_algo=None,
+             ser_algo=None):
 
     # Validate and setup parameters, retrieving defaults if necessary
     if comp_algo == None:
@@ -177,38 +347,78 @@ class DataStore(object):
     if protect_algo == None:
       protect_algo = self._protect_algo
     assert ProtectAlgo.validate(protect_algo)
-
-    # Generate the binary buffer for the object
-    buf = cPickle.dumps(obj, protocol=2)
-
-    # Apply compression, if necessary
+    if ser_algo == None:
+      ser_algo = self._ser_algo
+    assert SerAlgo.validate(ser_algo)
+
+    # Generate the binary buffer for the object. Objects that msgpack cannot
+    # encode exactly are pickled instead.
+    buf = None
+    if ser_algo == SerAlgo.msgpack:
+      buf = _msgpack_dumps(obj)
+    if buf is None:
+      ser_algo = SerAlgo.pickle
+      buf = cPickle.dumps(obj, protocol=2)
+
+    # Apply compression, if necessary. Small buffers are left uncompressed (the
+    # header records it), since compressing them would not pay off.
+    if len(buf) < comp_thresholds.get(comp_algo, 0):
+      comp_algo = CompAlgo.uncompressed
     if comp_algo == CompAlgo.zlib:
       buf = zlib.compress(buf, comp_level)
     elif comp_algo == CompAlgo.bz2:
       buf = bz2.compress(buf, comp_level)
+    elif comp_algo == CompAlgo.zstd:
+      _check_module(zstandard, 'zstandard', 'zstd compression')
+      buf = zstandard.ZstdCompressor(level=comp_level).compress(buf)
+    elif comp_algo == CompAlgo.zstd_mt:
+      # Same format as zstd, compressed by one worker thread per CPU core
+      _check_module(zstandard, 'zstandard', 'zstd compression')
+      buf = zstandard.ZstdCompressor(level=comp_level, threads=-1).compress(buf)
       
-    # Apply encryption, if necessary
-    if crypt_algo == CryptAlgo.AES:
+    header_byte = (comp_algo << 5) | (crypt_algo << 2) | protect_algo
+    if ser_algo == SerAlgo.pickle:
+      header = _header_v0.pack(0, header_byte)
+    else:
+      header = _header_v1.pack(1, header_byte, ser_algo)
+
+    # Apply encryption, if necessary. When no protection is applied afterwards
+    # and the cipher supports it, the ciphertext is written directly after the
+    # header and IV in the final buffer, without intermediate copies.
+    if crypt_algo != CryptAlgo.unencrypted:
       IV = os.urandom(16)
-      crypt_key = hashlib.sha256(crypt_pwd).digest()
-      crypt_key = Crypto.Cipher.AES.new(crypt_key, Crypto.Cipher.AES.MODE_CFB, IV)
-      buf = IV + crypt_key.encrypt(buf)
+      cipher = _new_cipher(crypt_algo, crypt_pwd, IV)
+      if protect_algo == ProtectAlgo.unprotected and _pycryptodome:
+        prefix = header + IV
+        out = bytearray(len(prefix) + len(buf))
+        out[:len(prefix)] = prefix
+        cipher.encrypt(buf, output=memoryview(out)[len(prefix):])
+        return self.setdata(key, out)
+      buf = IV + cipher.encrypt(buf)
 
     # Apply protection, if necessary
     if protect_algo == ProtectAlgo.DPAPI:
       buf = dpapi.cryptData(buf)
 
     # Prepend the header and write the buffer in the underlying store
-    proto_ver = 0
-    header_byte = (comp_algo << 5) | (crypt_algo << 2) | protect_algo
-    buf = chr(proto_ver) + chr(header_byte) + buf
-    return self.setdata(key, buf)
+    return self.setdata(key, header + buf)
 
 class SqliteTable(object):
 
+  # Applied to every connection. WAL with synchronous=NORMAL only syncs at
+  # checkpoints, instead of on every commit.
+  pragmas = ['PRAGMA journal_mode=WAL',
+             'PRAGMA synchronous=NORMAL',
+             'PRAGMA temp_store=MEMORY',
+             'PRAGMA mmap_size=268435456']
+
   @classmethod
   def connect(cls, db_path, *tables_to_create):
     conn = apsw.Connection(db_path)
+    for pragma in cls.pragmas:
+      if trace_sql:
+        print pragma
+      list(conn.cursor().execute(pragma))
     for table_class in tables_to_create:
       assert issubclass(table_class, cls)
       table_class.colnames = [c[0] for c in table_class.columns]
@@ -224,47 +434,107 @@ class SqliteTable(object):
         conn.cursor().execute(query_str)
       if hasattr(table_class, 'default_rows'):
         for row in table_class.default_rows:
-          if not table_class.exists(**row):
+          if not table_class.exists(conn, **row):
             table_class.insert(conn, **row)
     return conn
 
   @classmethod
-  def select(cls, conn, cols, **kwargs):
-    assert set(kwargs.keys()).issubset(cls.colnames)
+  @_cached_query
+  def select_query(cls, cols, names, limit=None):
+    assert set(names).issubset(cls.colnames)
+    query_str = 'SELECT {} FROM tbl_{}'.format(cols or '*', cls.__name__)
+    if names:
+      query_str += ' WHERE '
+      query_str += ' AND '.join('{}=?'.format(n) for n in names)
+    if limit:
+      query_str += ' LIMIT {}'.format(limit)
+    query_str += ';'
+    return query_str
+
+  @classmethod
+  @_cached_query
+  def insert_query(cls, cols):
     if not cols:
-      cols = '*'
-    query_str = 'SELECT {} FROM tbl_{}'.format(cols, cls.__name__)
-    if kwargs:
+      return 'INSERT INTO tbl_{} DEFAULT VALUES'.format(cls.__name__)
+    assert set(cols).issubset(cls.colnames), '{}, {}'.format(cols, cls.colnames)
+    joined_colnames = ','.join("'{}'".format(c) for c in cols)
+    return 'INSERT INTO tbl_{} ({}) VALUES ({})'.format(cls.__name__, joined_colnames, ','.join('?' for c in cols))
+
+  @classmethod
+  @_cached_query
+  def update_query(cls, val_cols, key_cols):
+    assert set(key_cols).issubset(cls.colnames), (set(key_cols), cls.colnames)
+    assert set(val_cols).issubset(cls.colnames)
+    key_str = ' AND '.join('{}=?'.format(k) for k in key_cols)
+    val_str = ','.join('{}=?'.format(k) for k in val_cols)
+    return 'UPDATE tbl_{} SET {} WHERE {}'.format(cls.__name__, val_str, key_str)
+
+  @classmethod
+  @_cached_query
+  def upsert_query(cls, key_cols, val_cols):
+    """
+    Returns an INSERT statement that updates val_cols instead when a row with
+    the same key_cols already exists. key_cols must match a UNIQUE constraint
+    (or the primary key) of the table. The parameters are the key_cols values
+    followed by the val_cols values.
+    """
+    assert set(key_cols).issubset(cls.colnames), (set(key_cols), cls.colnames)
+    assert set(val_cols).issubset(cls.colnames)
+    cols = key_cols + val_cols
+    return 'INSERT INTO tbl_{} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}'.format(
+      cls.__name__, ','.join(cols), ','.join('?' for c in cols), ','.join(key_cols),
+      ','.join('{0}=excluded.{0}'.format(c) for c in val_cols))
+
+  @classmethod
+  @_cached_query
+  def delete_query(cls, cols):
+    assert set(cols).issubset(cls.colnames)
+    query_str = 'DELETE FROM tbl_{}'.format(cls.__name__)
+    if cols:
       query_str += ' WHERE '
-      query_str += ' AND '.join('{}=?'.format(kw) for kw in kwargs)
+      query_str += ' AND '.join('{}=?'.format(col) for col in cols)
     query_str += ';'
+    return query_str
+
+  @classmethod
+  def select(cls, conn, cols, **kwargs):
+    names = tuple(sorted(kwargs))
+    query_str = cls.select_query(cols, names)
+    params = [kwargs[n] for n in names]
     if trace_sql:
-      print query_str, kwargs.values()
-    return conn.cursor().execute(query_str, kwargs.values())
+      print query_str, params
+    return conn.cursor().execute(query_str, params)
+
+  @classmethod
+  def select_one(cls, conn, cols, **kwargs):
+    """
+    Returns the first row matching kwargs, or None if there is none.
+    """
+    names = tuple(sorted(kwargs))
+    query_str = cls.select_query(cols, names, 1)
+    params = [kwargs[n] for n in names]
+    if trace_sql:
+      print query_str, params
+    return conn.cursor().execute(query_str, params).fetchone()
 
   @classmethod
   def exists(cls, conn, **kwargs):
-    return bool(cls.select(conn, **kwargs))
+    return cls.select_one(conn, '1', **kwargs) is not None
 
   @classmethod
   def insert(cls, conn, **kwargs):
-    if kwargs:
-      assert set(kwargs.keys()).issubset(cls.colnames), '{}, {}'.format(kwargs, cls.colnames)
-      joined_colnames = ','.join("'{}'".format(c) for c in kwargs)
-      query = 'INSERT INTO tbl_{} ({}) VALUES ({})'.format(cls.__name__, joined_colnames, ','.join('?' for k in kwargs))
-    else:
-      query = 'INSERT INTO tbl_{} DEFAULT VALUES'.format(cls.__name__)
+    names = tuple(sorted(kwargs))
+    query = cls.insert_query(names)
+    params = [kwargs[n] for n in names]
     if trace_sql:
-      print query, kwargs.values()
+      print query, params
     with conn, contextlib.closing(conn.cursor()) as cur:
-      cur.execute(query, kwargs.values())
+      cur.execute(query, params)
       return cur.lastrowid
 
   @classmethod
   def insertmany(cls, conn, cols, tuples):
-    assert set(cols).issubset(cls.colnames), '{}, {}'.format(cols, cls.colnames)
-    joined_colnames = ','.join("'{}'".format(c) for c in cols)
-    query = 'INSERT INTO tbl_{} ({}) VALUES ({})'.format(cls.__name__, joined_colnames, ','.join('?' for k in cols))
+    query = cls.insert_query(tuple(cols))
     if trace_sql:
       print query, cols, tuples
     with conn:
@@ -279,30 +549,39 @@ class SqliteTable(object):
                         the existing row.
       - val_cols:       values to update in the DB, but that won't be used
                         to select.
-      - insert_missing: inserts a new item if it was not found.
+      - insert_missing: inserts a new item if it was not found. The key_cols
+                        must then match a UNIQUE constraint of the table.
     """
-    assert set(key_cols).issubset(cls.colnames)
-    assert set(val_cols).issubset(cls.colnames)
-    if insert_missing and not cls.exists(conn, **key_cols):
-      cls.insert(conn, **dict(key_cols.items() + val_cols.items()))
+    keys = tuple(sorted(key_cols))
+    vals = tuple(sorted(val_cols))
+    if insert_missing:
+      query = cls.upsert_query(keys, vals)
+      params = [key_cols[k] for k in keys] + [val_cols[v] for v in vals]
     else:
-      key_str = ','.join('{}=?'.format(k) for k in key_cols)
-      val_str = ','.join('{}=?'.format(k) for k in val_cols)
-      query = 'UPDATE tbl_{} SET {} WHERE {}'.format(cls.__name__, val_str, key_str)
-      if trace_sql:
-        print query
-        print val_cols.values() + key_cols.values()
-      with conn:
-        conn.cursor().execute(query, val_cols.values() + key_cols.values())
+      query = cls.update_query(vals, keys)
+      params = [val_cols[v] for v in vals] + [key_cols[k] for k in keys]
+    if trace_sql:
+      print query
+      print params
+    with conn:
+      conn.cursor().execute(query, params)
 
   @classmethod
   def updatemany(cls, conn, val_cols, key_cols, tuples):
     assert cls.colnames, cls.colnames
-    assert set(key_cols).issubset(cls.colnames), (set(key_cols), cls.colnames)
-    assert set(val_cols).issubset(cls.colnames)
-    key_str = ','.join('{}=?'.format(k) for k in key_cols)
-    val_str = ','.join('{}=?'.format(k) for k in val_cols)
-    query = 'UPDATE tbl_{} SET {} WHERE {}'.format(cls.__name__, val_str, key_str)
+    query = cls.update_query(tuple(val_cols), tuple(key_cols))
+    if trace_sql:
+      print query, tuples
+    with conn:
+      conn.cursor().executemany(query, tuples)
+
+  @classmethod
+  def upsertmany(cls, conn, key_cols, val_cols, tuples):
+    """
+    Inserts or updates many rows in a single transaction. Each tuple holds the
+    values of key_cols followed by the values of val_cols. See update.
+    """
+    query = cls.upsert_query(tuple(key_cols), tuple(val_cols))
     if trace_sql:
       print query, tuples
     with conn:
@@ -310,25 +589,17 @@ class SqliteTable(object):
 
   @classmethod
   def delete(cls, conn, **kwargs):
-    assert set(kwargs.keys()).issubset(cls.colnames)
-    query_str = 'DELETE FROM tbl_{}'.format(cls.__name__)
-    if kwargs:
-      query_str += ' WHERE '
-      query_str += ' AND '.join('{}=?'.format(kw) for kw in kwargs)
-    query_str += ';'
+    names = tuple(sorted(kwargs))
+    query_str = cls.delete_query(names)
+    params = [kwargs[n] for n in names]
     if trace_sql:
-      print query_str, kwargs.values()
+      print query_str, params
     with conn:
-      conn.cursor().execute(query_str, kwargs.values())
+      conn.cursor().execute(query_str, params)
 
   @classmethod
   def deletemany(cls, conn, cols, tuples):
-    assert set(cols).issubset(cls.colnames)
-    query_str = 'DELETE FROM tbl_{}'.format(cls.__name__)
-    if cols:
-      query_str += ' WHERE '
-      query_str += ' AND '.join('{}=?'.format(col) for col in cols)
-    query_str += ';'
+    query_str = cls.delete_query(tuple(cols))
     if trace_sql:
       print query_str, tuples
     with conn:
@@ -348,15 +619,18 @@ class DB(DataStore):
   """
   Store key/value pairs in a DB.
   """
+
+  __slots__ = ('_db_path', '_conn')
+
   def __init__(self, db_path, **kwargs):
     super(DB, self).__init__(**kwargs)
-    self._priv['_db_path'] = db_path
-    self._priv['_conn']    = SqliteTable.connect(db_path, DB_table)
+    self._db_path = db_path
+    self._conn    = SqliteTable.connect(db_path, DB_table)
     if not DB_table.exists(self._conn, key='id'):
       DB_table.insert(self._conn, key='id', value=buffer(uuid.uuid4().bytes), update_time=time.time())
 
   def getid(self):
-    return binascii.hexlify(DB_table.select(self._conn, key='id').value)
+    return binascii.hexlify(DB_table.select_one(self._conn, 'value', key='id')[0])
 
   def getname(self):
     return self._db_path
@@ -364,40 +638,71 @@ class DB(DataStore):
   def getdata(self, key):
     if key == 'id':
       raise Exception('"id" is a reserved key')
-    rows = DB_table.select(self._conn, key=key)
-    if rows:
-      row = rows[0]
-      return row.value, datetime.datetime.fromtimestamp(row.update_time)
-    return None, None
+    row = DB_table.select_one(self._conn, 'value,update_time', key=key)
+    if row is None:
+      return None, None
+    return row[0], datetime.datetime.fromtimestamp(row[1])
 
   def getupdtime(self, key):
     if key == 'id':
       raise Exception('"id" is a reserved key')
-    return datetime.datetime.fromtimestamp(DB_table.select(self._conn, key=key).update_time)
+    row = DB_table.select_one(self._conn, 'update_time', key=key)
+    if row is None:
+      return None
+    return datetime.datetime.fromtimestamp(row[0])
 
-  def setdata(self, key, data, overwrite=True):
-
-    # Validate parameters
+  def _check_key(self, key):
+    """
+    Validates a key for writing and returns it without the unnecessary / at
+    its beginning.
+    """
     if key == 'id':
       raise Exception('"id" is a reserved key')
     if not key:
       raise Exception('key invalid: empty or None')
     if key[0] == '/':
-      key = key[1:] # Remove unnecessary / at beginning of key
+      key = key[1:]
+    return key
 
-    DB_table.update(self._conn, {'key':key}, {'value':buffer(data), 'update_time':time.time()}, insert_missing=True)
+  def setdata(self, key, data, overwrite=True):
+    key = self._check_key(key)
+    upd_time = time.time()
+    DB_table.update(self._conn, {'key':key}, {'value':buffer(data), 'update_time':upd_time}, insert_missing=True)
+    return datetime.datetime.fromtimestamp(upd_time)
+
+  def setdata_many(self, pairs):
+    """
+    Sets the data of many keys in a single transaction. pairs is an iterable
+    of (key, data) tuples. Returns the update time.
+    """
+    upd_time = time.time()
+    rows = []
+    for key, data in pairs:
+      rows.append((self._check_key(key), buffer(data), upd_time))
+    DB_table.upsertmany(self._conn, ['key'], ['value', 'update_time'], rows)
+    return datetime.datetime.fromtimestamp(upd_time)
 
   def listkeys(self, prefix=None):
-    return dict((row.key, row.update_time) for row in DB_table.select(self._conn))
+    keys = dict()
+    for key, upd_time in DB_table.select(self._conn, 'key,update_time'):
+      if prefix and not key.startswith(prefix):
+        continue
+      keys[key] = datetime.datetime.fromtimestamp(upd_time)
+    keys.pop('id', None)
+    return keys
 
 class Dir(DataStore):
   """
   Store key/value pairs in a directory.
   """
 
+  __slots__ = ('_path', '_real_path', '_known_dirs')
+
   def __init__(self, path):
     super(Dir, self).__init__()
-    self._priv['_path'] = unicode(os.path.abspath(path))
+    self._path       = unicode(os.path.abspath(path))
+    self._real_path  = os.path.join(os.path.realpath(self._path), '') # With trailing separator
+    self._known_dirs = set() # Directories known to exist in the store
     if not os.path.isdir(self._path):
       os.mkdir(self._path)
     id_path = os.path.join(self._path, 'id')
@@ -413,19 +718,67 @@ class Dir(DataStore):
   def getname(self):
     return self._path
 
-  def getdata(self, key):
+  def _key_path(self, key):
+    """
+    Returns the file path of key, normalized like setdata does, or None if the
+    path falls outside of the store.
+    """
+    if key[:1] == '/':
+      key = key[1:] # Remove unnecessary / at beginning of key
     if key == 'id':
       raise Exception('"id" is a reserved key')
-    keys = self.listkeys()
-    if key in keys:
-      fname = os.path.join(self._path, key)
-      with open(fname, 'rb') as f:
-        return f.read(), self.getupdtime(key)
+    fname = os.path.join(self._path, key)
+    if not os.path.realpath(fname).startswith(self._real_path):
+      return None
+    return fname
+
+  def _open_data(self, key):
+    """
+    Returns the open file of key and its stat result, or (None, None) if the
+    key does not exist.
+    """
+    fname = self._key_path(key)
+    if fname is None:
+      return None, None
+    try:
+      f = open(fname, 'rb')
+    except IOError as ex:
+      if ex.errno in (errno.ENOENT, errno.ENOTDIR) or os.path.isdir(fname):
+        return None, None
+      raise
+    return f, os.fstat(f.fileno())
+
+  def getdata(self, key):
+    f, st = self._open_data(key)
+    if f is None:
+      return None, None
+    with f:
+      return f.read(), datetime.datetime.fromtimestamp(st.st_mtime)
+
+  def getobj(self, key, crypt_pwd=None):
+    """
+    Same as DataStore.getobj, but files of at least mmap_threshold bytes are
+    decoded from a read-only memory map instead of a copy, and the map is
+    closed before returning.
+    """
+    f, st = self._open_data(key)
+    if f is None:
+      return (None, None)
+    upd_time = datetime.datetime.fromtimestamp(st.st_mtime)
+    with f:
+      if st.st_size < mmap_threshold:
+        buf = f.read()
+      else:
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as buf:
+          return self._decode(buf, crypt_pwd), upd_time
+    if not buf:
+      return (None, None)
+    return self._decode(buf, crypt_pwd), upd_time
 
   def getupdtime(self, key):
-    if key == 'id':
-      raise Exception('"id" is a reserved key')
-    fname = os.path.join(self._path, key)
+    fname = self._key_path(key)
+    if fname is None:
+      return None
     return datetime.datetime.fromtimestamp(os.path.getmtime(fname))
 
   def setdata(self, key, data):
@@ -445,25 +798,36 @@ class Dir(DataStore):
     file_part = tokens.pop() # The last item should represent the "file" part, e.g.,
                              # items/my_key. In that example, the last token is my_key,
                              # and it is the file. Other tokens are going to be directories.
-    for token in tokens:
-      data_path = os.path.join(data_path, token)
-      if not os.path.isdir(data_path):
-        os.mkdir(data_path)
-    data_path = os.path.join(data_path, file_part)
-    with open(data_path, 'wb') as f:
-      f.write(data)
-    return datetime.datetime.fromtimestamp(os.path.getmtime(data_path))
+    dir_path = os.path.join(data_path, *tokens)
+    if dir_path not in self._known_dirs:
+      try:
+        os.makedirs(dir_path)
+      except OSError as ex:
+        if ex.errno != errno.EEXIST:
+          raise
+      self._known_dirs.add(dir_path)
+    data_path = os.path.join(dir_path, file_part)
+
+    # Write the data without going through a file object buffer, and get the
+    # update time from the still open file
+    fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o644)
+    try:
+      written = 0
+      while written < len(data):
+        written += os.write(fd, buffer(data, written))
+      mtime = os.fstat(fd).st_mtime
+    finally:
+      os.close(fd)
+    return datetime.datetime.fromtimestamp(mtime)
 
   def listkeys(self, prefix=None):
     keys = dict()
-    for (dirpath, dirnames, filenames) in os.walk(self._path):
-      for filename in filenames:
-        fname = os.path.join(dirpath, filename)  
-        assert(os.path.isfile(fname))
-        key = os.path.relpath(fname, self._path).replace(os.sep, '/')
-        if prefix and not key.startswith(prefix):
-          continue
-        keys[key] = datetime.datetime.fromtimestamp(os.path.getmtime(fname))
+    root_len = len(os.path.join(self._path, ''))
+    for entry in _iter_files(self._path):
+      key = entry.path[root_len:].replace(os.sep, '/')
+      if prefix and not key.startswith(prefix):
+        continue
+      keys[key] = datetime.datetime.fromtimestamp(entry.stat().st_mtime)
     keys.pop('id', None)
     return keys
       
@@ -8,11 +8,27 @@ class TestTable(datastore.SqliteTable):
              ('name' , 'TEXT NOT NULL'      ),
              ('value', 'INTEGER NOT NULL'  )]
 
-conn = datastore.SqliteTable.connect(':memory:', TestTable)
+class TestUniqueTable(datastore.SqliteTable):
+  columns = [('id'   , 'INTEGER PRIMARY KEY' ),
+             ('name' , 'TEXT NOT NULL UNIQUE'),
+             ('value', 'INTEGER NOT NULL'   )]
+
+conn = datastore.SqliteTable.connect(':memory:', TestTable, TestUniqueTable)
 TestTable.insert(conn, name='abc', value='3')
 TestTable.insert(conn, name='def', value='4')
 for name,value in TestTable.select(conn, 'name,value', name='def'):
   assert_eq(4, value)
+assert_eq((4,), TestTable.select_one(conn, 'value', name='def'))
+assert_eq(None, TestTable.select_one(conn, 'value', name='ghi'))
+assert TestTable.exists(conn, name='abc')
+assert not TestTable.exists(conn, name='ghi')
+
+TestUniqueTable.update(conn, {'name':'abc'}, {'value':1}, insert_missing=True)
+TestUniqueTable.update(conn, {'name':'abc'}, {'value':2}, insert_missing=True)
+TestUniqueTable.upsertmany(conn, ['name'], ['value'], [('abc', 3), ('def', 4)])
+assert_eq(2, TestUniqueTable.count_rows(conn))
+for (value,) in TestUniqueTable.select(conn, 'value', name='abc'):
+  assert_eq(3, value)
 
 print 'All tests successful.'
 
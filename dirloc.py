@@ -19,17 +19,29 @@ class MissingDir(Exception):
   pass
 
 class Dir(object):
-  def __init__(self, path, req):
+  def __init__(self, path, req, lazy=False):
+    """
+    A lazy Dir does not touch the file system until resolve() is called.
+    """
     self.path = path
     self.req = req
-    if os.path.isdir(path):
-      self.path = os.path.abspath(path)
+    if not lazy:
+      self.resolve()
+  def resolve(self):
+    """
+    Checks the directory (if required) and makes its path absolute. Returns
+    self.
+    """
+    if os.path.isdir(self.path):
+      self.path = os.path.abspath(self.path)
     elif self.req:
-      raise MissingDir, 'Could not locate path (%s), but the path was marked as "required"' % (path,)
+      raise MissingDir, 'Could not locate path (%s), but the path was marked as "required"' % (self.path,)
+    return self
   def __str__(self):
     return self.path
   def __getattr__(self, name):
-    return Dir(self.join(name), self.req)
+    # Subdirectories are not checked until resolve() is called on them
+    return Dir(self.join(name), self.req, lazy=True)
   def exists(self):
     return os.path.exists(self.path)
   def join(self, otherPath):
@@ -44,7 +56,7 @@ def usbkey(req=True):
   return Dir(find_drive(driveKeys['usbkey']), req)
 
 def lacie(req=True):
-  return Dir(find_drive(driveKeys['lacie']), req).home
+  return Dir(find_drive(driveKeys['lacie']), req).home.resolve()
 
 def dropbox(req=True):
   d = Dir(r'C:\home\dropbox', req)
@@ -55,12 +67,20 @@ def dropbox(req=True):
 def seagate(req=True):
   return Dir(find_drive(driveKeys['seagate']), req)
 
+_drive_cache = dict() # driveKey -> drive found by find_drive
+
 def find_drive(driveKey):
+  drive = _drive_cache.get(driveKey)
+  if drive:
+    return drive
   for letter in candidateDriveLetters:
     drive = letter + ':\\'
     if os.path.exists(drive + driveKey):
-      return drive
-  return 'UNK:\\'
+      break
+  else:
+    drive = 'UNK:\\'
+  _drive_cache[driveKey] = drive
+  return drive
 
 def lookup_path(path, req=True):
   """
@@ -90,7 +110,7 @@ def lookup_path(path, req=True):
       dir = Dir(path_components[0], req)
   for comp in path_components[1:]:
     dir = getattr(dir, comp)
-  return dir
+  return dir.resolve()
 
 def main():
   """
@@ -110,7 +130,7 @@ def main():
   dir = lookup_path(args[0])
 
   # Open the file explorer on the path
-  subprocess.Popen('explorer ' + str(dir))
+  subprocess.Popen(['explorer', str(dir)])
 
 if __name__ == '__main__':
   main()
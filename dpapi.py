@@ -9,7 +9,6 @@ from ctypes import *
 from ctypes.wintypes import DWORD
 
 LocalFree = windll.kernel32.LocalFree
-memcpy = cdll.msvcrt.memcpy
 CryptProtectData = windll.crypt32.CryptProtectData
 CryptUnprotectData = windll.crypt32.CryptUnprotectData
 CRYPTPROTECT_UI_FORBIDDEN = 0x01
@@ -18,36 +17,50 @@ extraEntropy = "dfgh9r8y39**/40304g0349g(G$((G$(G()$()G/()$Grejigferghzxczxc"
 class DATA_BLOB(Structure):
     _fields_ = [("cbData", DWORD), ("pbData", POINTER(c_char))]
 
-def getData(blobOut):
-    cbData = int(blobOut.cbData)
-    pbData = blobOut.pbData
-    buffer = c_buffer(cbData)
-    memcpy(buffer, pbData, cbData)
-    LocalFree(pbData);
-    return buffer.raw
+# Built once, since most calls use the default entropy
+_extraEntropyBuffer = c_buffer(extraEntropy, len(extraEntropy))
+_extraEntropyBlob = DATA_BLOB(len(extraEntropy), _extraEntropyBuffer)
+_description = u"python_data"
+
+def getEntropyBlob(entropy):
+    if entropy is extraEntropy:
+        return _extraEntropyBlob
+    bufferEntropy = c_buffer(entropy, len(entropy))
+    return DATA_BLOB(len(entropy), bufferEntropy) # The blob keeps bufferEntropy alive
+
+def getData(blobOut, wipe=False):
+    # Copy the output straight into a string, then release it, wiping it first
+    # if it holds plaintext. RtlSecureZeroMemory is an inline function, not a
+    # kernel32 export, but a ctypes memset call cannot be optimized away either.
+    data = string_at(blobOut.pbData, blobOut.cbData)
+    if wipe:
+        memset(blobOut.pbData, 0, blobOut.cbData)
+    LocalFree(blobOut.pbData)
+    return data
 
 def Win32CryptProtectData(plainText, entropy):
     bufferIn = c_buffer(plainText, len(plainText))
     blobIn = DATA_BLOB(len(plainText), bufferIn)
-    bufferEntropy = c_buffer(entropy, len(entropy))
-    blobEntropy = DATA_BLOB(len(entropy), bufferEntropy)
+    blobEntropy = getEntropyBlob(entropy)
     blobOut = DATA_BLOB()
 
-    if CryptProtectData(byref(blobIn), u"python_data", byref(blobEntropy),
-                       None, None, CRYPTPROTECT_UI_FORBIDDEN, byref(blobOut)):
-        return getData(blobOut)
-    else:
-        return ""
+    try:
+        if CryptProtectData(byref(blobIn), _description, byref(blobEntropy),
+                           None, None, CRYPTPROTECT_UI_FORBIDDEN, byref(blobOut)):
+            return getData(blobOut)
+        else:
+            return ""
+    finally:
+        memset(bufferIn, 0, len(plainText)) # Wipe the plaintext copy
 
 def Win32CryptUnprotectData(cipherText, entropy):
     bufferIn = c_buffer(cipherText, len(cipherText))
     blobIn = DATA_BLOB(len(cipherText), bufferIn)
-    bufferEntropy = c_buffer(entropy, len(entropy))
-    blobEntropy = DATA_BLOB(len(entropy), bufferEntropy)
+    blobEntropy = getEntropyBlob(entropy)
     blobOut = DATA_BLOB()
     if CryptUnprotectData(byref(blobIn), None, byref(blobEntropy), None, None,
                               CRYPTPROTECT_UI_FORBIDDEN, byref(blobOut)):
-        return getData(blobOut)
+        return getData(blobOut, wipe=True)
     else:
         return ""
 
@@ -7,6 +7,8 @@ and handling the user choices.
 Copyright (c) 2012, Francois Jeannotte.
 """
 
+import operator
+
 import cio
 
 class Menu(object):
@@ -52,10 +54,6 @@ class Menu(object):
       True when a valid item was selected, False if ESC was pressed.
     """
 
-    # The list of available keys (used to generate a key when none has been
-    # provided for a given item)
-    availKeys = list('abcdefghijklmnopqrstuvwxyz')
-
     # Loop on all items to validate the type of items, organize by key
     itemsNoKey = []
     itemsByKey = dict()
@@ -70,19 +68,20 @@ class Menu(object):
         if item.key in itemsByKey:
           raise Exception('Two items have the same key %s' % (item.key,))
         itemsByKey[item.key] = item
-        availKeys.remove(item.key)
 
-    # If some items have no key, generate a key for those
+    # If some items have no key, generate a key for those, from the letters not
+    # already used, in alphabetical order
+    availKeys = (k for k in 'abcdefghijklmnopqrstuvwxyz' if k not in itemsByKey)
     for item in itemsNoKey:
-      item.key = availKeys.pop(0)
-      if item.key in itemsByKey:
-        raise Exception('An auto generated key was already allocated')
+      item.key = next(availKeys, '')
+      if not item.key:
+        raise Exception('No key left to generate for item %s' % (item.text,))
       itemsByKey[item.key] = item
 
     # Print menu
-    sortedItems = sorted(self.items) if sort else self.items
+    sortedItems = sorted(self.items, key=operator.attrgetter('key')) if sort else self.items
     for i, item in enumerate(sortedItems):
-      item.lineNumber = cio.getcurpos().y
+      item.lineNumber = cio.getcurpos()[1]
       print item.getLine()
 
     # Wait for user input and return result(s)
@@ -124,22 +123,17 @@ class Item(object):
     self.key      = key
     self.flag     = flag
     self.actions  = actions
+    self.actionIdx = 0 # Index of the current action in actions
     self.toggle   = toggle
     self.obj      = obj
     self.callback = callback
     self.selected = False # This will be set to True if trigger is
                           # called at least once.
-  def __cmp__(self, other):
-    if self.key < other.key:
-      return -1
-    if self.key == other.key:
-      return 0
-    return 1
   def __str__(self):
     strVal = self.key + ') ' + self.text
     if self.selected:
       strVal = strVal + ' (selected)'
-    strVal = strVal + ' (action=' + self.actions[0] + ')'
+    strVal = strVal + ' (action=' + self.getAction() + ')'
     return strVal
   def __repr__(self):
     return '<menu.Item ' + self.key + ' ' + self.text + '>'
@@ -147,12 +141,14 @@ class Item(object):
     self.selected = True
     if self.callback:
       self.callback(self)
-    self.actions = self.actions[1:] + self.actions[0]
-    cio.putchxy(4, self.lineNumber, self.actions[0])
+    self.actionIdx = (self.actionIdx + 1) % len(self.actions)
+    cio.putchxy(4, self.lineNumber, self.getAction())
     return False if self.toggle else True
+  def getAction(self):
+    return self.actions[self.actionIdx]
   def getLine(self):
     line = ' ' + self.flag + ' '
-    line = line + '[' + self.actions[0] + '] '
+    line = line + '[' + self.getAction() + '] '
     line = line + self.key + ') ' + self.text
     return line
 
@@ -5,39 +5,42 @@ Copyright (c) 2012, Francois Jeannotte.
 """
 
 import collections
-import cPickle
-import datetime
-import functools
 import hashlib
 import itertools
-import operator
+import mmap
 import os
-import pprint
-import shutil
-import subprocess
-import sys
-import tempfile
 import time
-import timeit
+
+try:
+  from os import scandir
+except ImportError:
+  from scandir import scandir # Backport for Python 2
+
+try:
+  import pyblake2
+except ImportError:
+  pyblake2 = None # MD5 reports are digested with MD5
 
 class Enum(object):
   def __init__(self, defaults=None, **kwargs):
-    if defaults:
-      for i, elem_name in enumerate(s.strip() for s in defaults.split()):
-        assert not hasattr(self, elem_name)
-        setattr(self, elem_name, i)
-    for name,val in kwargs.iteritems():
-      assert not hasattr(self, name)
+    elems = enumerate(s.strip() for s in defaults.split()) if defaults else ()
+    seen = set()
+    for name, val in itertools.chain(((n, i) for i, n in elems), kwargs.iteritems()):
+      assert name not in self.__dict__ and name not in _enum_reserved, name
+      assert val not in seen, val
+      seen.add(val)
       setattr(self, name, val)
-    assert len(self.__dict__.values()) == len(set(self.__dict__.values()))
+    self._values = frozenset(seen)
   def validate(self, enum_value):
-    return enum_value in self.__dict__.values()
+    return enum_value in self._values
   def __repr__(self):
     s = '<Enum '
-    s += ', '.join('{}={}'.format(k, getattr(self, k)) for k in sorted(self.__dict__.keys()))
+    s += ', '.join('{}={}'.format(k, getattr(self, k)) for k in sorted(self.__dict__.keys()) if k != '_values')
     s += '>'  
     return s
 
+_enum_reserved = frozenset(dir(Enum)) | frozenset(['_values']) # Names elements cannot use
+
 class ExecCounter(object):
   def __init__(self):
     self.tot = 0
@@ -130,15 +133,15 @@ class ExecStats(object):
 
   def __str__(self):
 
-    s  = '--------------------------------------------------\n'
-    s += 'Timers\n'
+    parts = ['--------------------------------------------------\n']
+    parts.append('Timers\n')
     for name, node, depth in itertree(self.timer_root):
-      s += '  ' + 2*depth*' ' + name + ' ' + str(node.tot) + '\n'
-    s += 'Counters\n'
+      parts.append('  ' + 2*depth*' ' + name + ' ' + str(node.tot) + '\n')
+    parts.append('Counters\n')
     for name, counter in self.counters.iteritems():
-      s += '  ' + name + ' ' + str(counter.tot) + '\n'
-    s += '--------------------------------------------------\n'
-    return s
+      parts.append('  ' + name + ' ' + str(counter.tot) + '\n')
+    parts.append('--------------------------------------------------\n')
+    return ''.join(parts)
 
     # Compute average
     #for sec in self.counters:
@@ -167,15 +170,23 @@ def unique(iterable):
       seen.add(elem)
 
 def isplit(chars):
-  chars = iter(chars)
-  eq_space = functools.partial(operator.eq, ' ')
-  ne_space = functools.partial(operator.ne, ' ')
-  token = ''.join(itertools.takewhile(ne_space, itertools.dropwhile(eq_space, chars)))
-  while token:
-    yield token
-    token = ''.join(itertools.takewhile(ne_space, itertools.dropwhile(eq_space, chars)))
-
-def walkdir(rootdir, maxdepth=None, listfiles=True, listdirs=True, file_filter=None, file_wrapper=None, dir_wrapper=None, n=0):
+  """
+  Iterate on the tokens of chars separated by spaces. Strings are split in
+  one pass by str.split; other iterables of characters are consumed lazily.
+  """
+  if isinstance(chars, basestring):
+    return (token for token in chars.split(' ') if token)
+  return _isplit_iter(chars)
+
+def _isplit_iter(chars):
+  # Group runs of spaces and non-spaces with a C-level key. A set lookup is
+  # used since ' '.__eq__ returns NotImplemented (true) for unicode chars.
+  is_space = frozenset(' ').__contains__
+  for space, group in itertools.groupby(chars, is_space):
+    if not space:
+      yield ''.join(group)
+
+def walkdir(rootdir, maxdepth=None, listfiles=True, listdirs=True, file_filter=None, file_wrapper=None, dir_wrapper=None, n=0, followlinks=True):
   """
   Iterate on files and directories.
 
@@ -191,30 +202,48 @@ def walkdir(rootdir, maxdepth=None, listfiles=True, listdirs=True, file_filter=N
                    the file path in argument
     dir_wrapper  - if different than None, will be called and returned with
                    the dir path in argument
-    n            - internal argument used for recursive calls
+    n            - depth of rootdir, counted against maxdepth
+    followlinks  - if False, symlinks to directories are listed as dirs, but
+                   not recursed into
   """
   assert os.path.isdir(rootdir)
   if dir_wrapper:
     assert callable(dir_wrapper)
   if file_wrapper:
     assert callable(file_wrapper)
-  if maxdepth != None and n > maxdepth:
-    return
-  try:
-    items = os.listdir(rootdir)
-  except Exception, ex:
+
+  # Depth-first traversal, with a stack of (scandir iterator, depth) for the
+  # directories being listed. The cached entry types of scandir spare an
+  # isdir call per entry.
+  stack = []
+  def push(path, depth):
+    if maxdepth != None and depth > maxdepth:
+      return None
+    try:
+      stack.append((scandir(path), depth))
+    except Exception, ex:
+      return ex
+    return None
+  ex = push(rootdir, n)
+  if ex:
     yield rootdir, ex
-    return
-  for item in items:
-    path = os.path.join(rootdir, item)
-    if os.path.isdir(path):
+  while stack:
+    entries, depth = stack[-1]
+    entry = next(entries, None)
+    if entry is None:
+      stack.pop()
+      continue
+    path = entry.path
+    if entry.is_dir():
       if listdirs:
         if dir_wrapper:
           yield dir_wrapper(path), None
         else:
           yield path, None
-      for subitem in walkdir(path, maxdepth, listfiles, listdirs, file_filter, file_wrapper, dir_wrapper, n+1):
-        yield subitem
+      if followlinks or not entry.is_symlink():
+        ex = push(path, depth+1)
+        if ex:
+          yield path, ex
     else:
       if listfiles:
         if not file_filter or file_filter(path):
@@ -229,10 +258,12 @@ class TempDir(object):
   context management protocol.
   """
   def __init__(self):
+    import tempfile
     self.tempd = tempfile.mkdtemp()
   def __enter__(self):
     return self
   def __exit__(self, exc_type, exc_value, traceback):
+    import shutil
     shutil.rmtree(self.tempd)
   def __str__(self):
     return self.tempd
@@ -243,6 +274,7 @@ class TempFile(object):
   context management protocol.
   """
   def __init__(self, text=False, initial_data=None):
+    import tempfile
     temp_fd, self.tempf = tempfile.mkstemp(text=text)
     if initial_data:
       os.write(temp_fd, initial_data)
@@ -254,6 +286,32 @@ class TempFile(object):
   def __str__(self):
     return self.tempf
 
+def _hash_file(fullpath, m, block_size=0x100000):
+  """
+  Feed the whole file to hash object m in a single update call, through a
+  read-only memory map of the file, and return the hex digest. Files that
+  cannot be mapped (e.g., larger than the address space of a 32-bit process)
+  are read by blocks of block_size bytes instead.
+  """
+  with open(fullpath, "rb") as fd:
+    if os.fstat(fd.fileno()).st_size > 0: # Empty files cannot be mapped
+      try:
+        mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+      except (EnvironmentError, ValueError, OverflowError):
+        mm = None
+      if mm is None:
+        while True:
+          data = fd.read(block_size)
+          if not data:
+            break
+          m.update(data)
+      else:
+        try:
+          m.update(mm)
+        finally:
+          mm.close()
+  return m.hexdigest()
+
 def compute_md5(fullpath):
   """
   Compute the MD5 hash of the specified file.
@@ -265,15 +323,13 @@ def compute_md5(fullpath):
   if not os.path.isfile(fullpath):
     raise Exception('file %s cannot be found' % (fullpath,))
 
-  # Compute MD5
-  block_size = 0x20000
-  def upd(m, data):
-    m.update(data)
-    return m
-  with open(fullpath, "rb") as fd:
-    contents = iter(lambda: fd.read(block_size), "")
-    m = reduce(upd, contents, hashlib.md5())
-    return m.hexdigest()
+  return _compute_md5_fast(fullpath)
+
+def _compute_md5_fast(fullpath):
+  """
+  Compute the MD5 hash of fullpath, which the caller knows to be a file.
+  """
+  return _hash_file(fullpath, hashlib.md5())
 
 def compute_sha256(fullpath):
   """
@@ -287,14 +343,41 @@ def compute_sha256(fullpath):
     raise Exception('file %s cannot be found' % (fullpath,))
 
   # Compute hash
-  block_size = 0x20000
-  def upd(m, data):
-    m.update(data)
-    return m
-  with open(fullpath, "rb") as fd:
-    contents = iter(lambda: fd.read(block_size), "")
-    m = reduce(upd, contents, hashlib.sha256())
-    return m.hexdigest()
+  return _hash_file(fullpath, hashlib.sha256())
+
+def _scan(root):
+  """
+  Recursively yield (path, is_dir) for every entry under root. Like os.walk,
+  symlinks to directories are reported as directories but not recursed into,
+  and unreadable directories are skipped.
+  """
+  for item, ex in walkdir(root, file_wrapper=lambda path: (path, False),
+                          dir_wrapper=lambda path: (path, True), followlinks=False):
+    if ex is None:
+      yield item
+
+# Number of report rows sorted in memory by generate_md5_report. Larger
+# reports are sorted in chunks of this size on disk, and merged.
+report_chunk_size = 0x10000
+
+def _new_report_hash():
+  """
+  Returns the name and a new hash object of the algorithm digesting the lines
+  of a MD5 report: BLAKE2b, cut to the size of a MD5 digest, if pyblake2 is
+  installed, MD5 otherwise.
+  """
+  if pyblake2:
+    return 'BLAKE2b', pyblake2.blake2b(digest_size=16)
+  return 'MD5', hashlib.md5()
+
+def _report_row(entry):
+  """
+  Returns the "relpath\tdigest\n" report row of a (relpath, path) entry, path
+  being None for directories. Rows sort like (relpath, digest) tuples.
+  """
+  relpath, path = entry
+  digest = _compute_md5_fast(path) if path else 32*' '
+  return relpath + '\t' + digest + '\n'
 
 def generate_md5_report(root, report_file):
   """
@@ -305,40 +388,72 @@ def generate_md5_report(root, report_file):
   abbb2342b34b23b42b34b2 path_of_file
                          path_of_dir
   etc
+  The report digest in the header is the digest of those lines, with the
+  algorithm named by the header: BLAKE2b if pyblake2 is installed, else MD5.
   """
+  import datetime
+  import heapq
+  import multiprocessing.pool
+  import tempfile
   if os.path.exists(report_file):
     raise Exception('Report file %s already exists' % (report_file,))
   if not os.path.isdir(root):
     raise Exception('root %s is not a directory' % (root,))
   root = os.path.abspath(root)
-  lines = []
-  counter = 0
-  print 'Reading folder structure...'
-  start_exec = datetime.datetime.now()
-  for (dirpath, dirnames, filenames) in os.walk(root):
-    for dirname in dirnames:
-      counter = counter + 1
-      fulldirname = os.path.relpath(os.path.join(dirpath, dirname), root)
-      lines.append((fulldirname, '                                '))
-    for filename in filenames:
-      counter = counter + 1
-      fullfilename = os.path.relpath(os.path.join(dirpath, filename), root)
-      lines.append((fullfilename, compute_md5(os.path.abspath(os.path.join(dirpath, filename)))))
-  print 'Done. (in ' + str(datetime.datetime.now() - start_exec) + ')'
-  print '\nSorting entries...'
-  start_exec = datetime.datetime.now()
-  sorted_lines = sorted(lines)
-  print 'Done. (in ' + str(datetime.datetime.now() - start_exec) + ')'
-  print '\nWriting report to file...'
-  start_exec = datetime.datetime.now()
-  report_md5 = hashlib.md5(cPickle.dumps(sorted_lines)).hexdigest()
-  with open(report_file, 'w') as f:
-    f.write('Root directory: ' + root + '\n')
-    f.write('Report MD5: ' + report_md5 + '\n')
-    f.write('\n')
-    for line in sorted_lines:
-      f.write(line[1] + ' ' + line[0] + '\n')
-  print 'Done. (in ' + str(datetime.datetime.now() - start_exec) + ')'
+  root_len = len(os.path.join(root, ''))
+  entries = ((path[root_len:], None if is_dir else path) for (path, is_dir) in _scan(root))
+  chunks = []
+  try:
+    print 'Reading folder structure and computing MD5 of files...'
+    start_exec = datetime.datetime.now()
+    # Hashing releases the GIL, so threads overlap reading and hashing files.
+    # Code run on the pool threads must not import modules: with the Python 2
+    # import lock, that deadlocks when the report is generated during an import.
+    # Each chunk of rows is sorted, and all but the last are moved to disk.
+    pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+    try:
+      while True:
+        result = pool.map_async(_report_row, itertools.islice(entries, report_chunk_size), chunksize=16)
+        while not result.ready():
+          result.wait(1) # An untimed wait cannot be interrupted by Ctrl-C in Python 2
+        rows = result.get()
+        rows.sort()
+        if len(rows) < report_chunk_size:
+          break
+        chunk = tempfile.TemporaryFile()
+        chunk.writelines(rows)
+        chunk.seek(0)
+        chunks.append(chunk)
+    except:
+      pool.terminate() # Do not hash the rest of the batch, e.g. on KeyboardInterrupt
+      raise
+    pool.close()
+    pool.join()
+    print 'Done. (in ' + str(datetime.datetime.now() - start_exec) + ')'
+    print '\nWriting report to file...'
+    start_exec = datetime.datetime.now()
+    hash_name, m = _new_report_hash()
+    with open(report_file, 'w') as f:
+      f.write('Root directory: ' + root + '\n')
+      f.write('Report ' + hash_name + ': ')
+      digest_pos = f.tell() # The digest is written once all lines are hashed
+      f.write(2*m.digest_size*' ' + '\n')
+      f.write('\n')
+      # Lines are hashed and written by blocks, to limit the per line calls
+      fields = (row[:-1].rpartition('\t') for row in heapq.merge(rows, *chunks))
+      lines = (digest + ' ' + relpath + '\n' for (relpath, _, digest) in fields)
+      while True:
+        block = ''.join(itertools.islice(lines, 0x1000))
+        if not block:
+          break
+        m.update(block)
+        f.write(block)
+      f.seek(digest_pos)
+      f.write(m.hexdigest())
+    print 'Done. (in ' + str(datetime.datetime.now() - start_exec) + ')'
+  finally:
+    for chunk in chunks:
+      chunk.close()
 
 def edit_text(initial_text=None, as_list=True):
   """
@@ -349,18 +464,21 @@ def edit_text(initial_text=None, as_list=True):
     - as_list     : if False, the whole document is returned as
                     a single string. Otherwise, a list of lines is returned.
   """
+  import io
+  import subprocess
   init_dat = None
   if initial_text:
     init_dat = initial_text.encode('mbcs')
   with TempFile(text=True, initial_data=init_dat) as tempf:
-    subprocess.call('vi.bat ' + str(tempf))
-    with open(unicode(str(tempf), 'mbcs')) as f:
+    subprocess.call(['vi.bat', str(tempf)])
+    with io.open(str(tempf), encoding='mbcs') as f:
       if as_list:
-        return [unicode(line, 'mbcs') for line in f.readlines()]
+        return f.readlines()
       else:
         return f.read()
 
 def main():
+  import sys
   test_isplit()
   return
   if len(sys.argv) == 2:
@@ -384,6 +502,7 @@ def test_sha256_perf():
     compute_sha256(file)
 
 def test_hash_perf():
+  import timeit
   count = 1
 
   print 'MD5:'